@@ -2,7 +2,10 @@ import os
 import sys
 import math
 import pprint
+import hashlib
 import logging
+import functools
+from collections import namedtuple
 from datetime import datetime
 
 import numpy as np
@@ -14,8 +17,10 @@ from tqdm import tqdm
 import torch
 from torch import nn, optim, autograd
 from torch.nn import functional as F
-from torchtext.data import Dataset, Field, Example
-from torchtext.vocab import Vectors, pretrained_aliases
+from torch.autograd import Variable
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torchtext.data import Field
+from torchtext.vocab import pretrained_aliases
 
 import common
 import preprocessing
@@ -26,19 +31,138 @@ logger = logging.getLogger(__name__)
 
 RANDOM_SEED = 71785514
 
+VOCAB_DIR = os.path.join(common.OUTPUT_DIR, 'vocab')
+# Increment when build_vocab changes, to invalidate the cached vocabularies
+VOCAB_VERSION = 1
+if not os.path.isdir(VOCAB_DIR):
+    os.makedirs(VOCAB_DIR)
+
 
 class CommentsDataset(Dataset):
 
-    def __init__(self, df, fields, **kwargs):
+    def __init__(self, df, text, vocab):
+        self.pad_index = vocab.stoi['<PAD>']
+        # Store the token indices of all the comments in one contiguous buffer, with
+        # the comment i at tokens[offsets[i]:offsets[i + 1]]
+        comments = [text[id_] for id_ in df['id']]
+        self.lengths = np.array([len(t) for t in comments])
+        self.offsets = np.zeros(len(comments) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.tokens = np.concatenate(comments).astype(np.int32, copy=False)
         if common.LABELS[0] in df.columns:
-            labels = df[common.LABELS].values.astype(np.float)
+            self.labels = df[common.LABELS].values.astype(np.float32, copy=False)
+        else:
+            self.labels = np.full((df.shape[0], len(common.LABELS)), np.nan, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]], self.labels[i]
+
+
+class BucketBatchSampler(Sampler):
+    """Group comments of similar length into the same batches to minimize the padding.
+
+    As in torchtext's BucketIterator, the comments are shuffled, sorted by length within
+    pools of `pool_size` batches, split into batches and the batches are shuffled again.
+    """
+
+    def __init__(self, lengths, batch_size, pool_size=100):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+
+    def __iter__(self):
+        indices = np.random.permutation(len(self.lengths))
+        pool_len = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, len(indices), pool_len):
+            pool = indices[start:start + pool_len]
+            pool = pool[np.argsort(self.lengths[pool], kind='mergesort')]
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        for batch_index in np.random.permutation(len(batches)):
+            yield batches[batch_index].tolist()
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+CommentsBatch = namedtuple('CommentsBatch', ['text', 'labels'])
+
+
+class CommentsLoader(DataLoader):
+    """Load batches of comments in background worker processes.
+
+    The batches are padded by the workers into page-locked memory and copied to the
+    GPU asynchronously on a separate stream, one batch ahead, so that both the data
+    preparation and the transfers overlap with the computation.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=False, bucket=False, sort_within_batch=False,
+                 use_cuda=True, volatile=False, **kwargs):
+        if bucket:
+            kwargs['batch_sampler'] = BucketBatchSampler(dataset.lengths, batch_size)
         else:
-            labels = np.full(df.shape[0], np.nan)
-        examples = []
-        for values in zip(df['comment_text'], labels):
-            example = Example.fromlist(values, fields)
-            examples.append(example)
-        super().__init__(examples, fields, **kwargs)
+            kwargs.update(batch_size=batch_size, shuffle=shuffle)
+        collate_fn = functools.partial(
+            collate_comments,
+            pad_index=dataset.pad_index,
+            sort_within_batch=sort_within_batch)
+        super().__init__(
+            dataset, collate_fn=collate_fn,
+            num_workers=min(8, os.cpu_count()), pin_memory=use_cuda, **kwargs)
+        self.use_cuda = use_cuda
+        self.volatile = volatile
+        self.copy_stream = torch.cuda.Stream() if use_cuda else None
+
+    def __iter__(self):
+        batches = super().__iter__()
+        if self.use_cuda:
+            batches = self.prefetch(batches)
+        for (text, text_lengths), labels in batches:
+            text = Variable(text, volatile=self.volatile)
+            labels = Variable(labels, volatile=self.volatile)
+            yield CommentsBatch((text, text_lengths), labels)
+
+    def prefetch(self, batches):
+        current_stream = torch.cuda.current_stream()
+        ready = None
+        for (text, text_lengths), labels in batches:
+            if ready is not None:
+                current_stream.wait_stream(self.copy_stream)
+            # Don't reuse the memory of the previous batches before the queued kernels are done with it
+            self.copy_stream.wait_stream(current_stream)
+            with torch.cuda.stream(self.copy_stream):
+                # The lengths stay on the CPU, pack_padded_sequence needs them there
+                loaded = (to_cuda(text), text_lengths), to_cuda(labels)
+            if ready is not None:
+                yield ready
+            ready = loaded
+        if ready is not None:
+            current_stream.wait_stream(self.copy_stream)
+            yield ready
+
+
+def collate_comments(examples, pad_index, sort_within_batch=False):
+    texts, labels = zip(*examples)
+    lengths = np.array([len(t) for t in texts])
+    if sort_within_batch:
+        # Sort by decreasing length (required by pack_padded_sequence), reusing the computed lengths
+        sort_indices = np.argsort(-lengths, kind='mergesort')
+        texts = [texts[i] for i in sort_indices]
+        labels = [labels[i] for i in sort_indices]
+        lengths = lengths[sort_indices]
+    text = np.full((len(texts), lengths.max()), pad_index, dtype=np.int64)
+    for i, t in enumerate(texts):
+        text[i, :lengths[i]] = t
+    labels = np.array(labels, dtype=np.float32)
+    return (torch.from_numpy(text), torch.from_numpy(lengths)), torch.from_numpy(labels)
+
+
+def to_cuda(tensor):
+    # The second argument of cuda() makes the copy asynchronous
+    return tensor.cuda(None, True)
 
 
 class BaseModel(object):
@@ -47,6 +171,7 @@ class BaseModel(object):
         self.name = self.__class__.__name__.lower()
         self.params = params
         self.random_seed = random_seed
+        self.use_cuda = torch.cuda.is_available()
 
         self.output_dir = os.path.join(
             common.OUTPUT_DIR,
@@ -68,13 +193,26 @@ class BaseModel(object):
         np.random.seed(int.from_bytes(self.random_state.bytes(4), byteorder=sys.byteorder))
         torch.manual_seed(int.from_bytes(self.random_state.bytes(4), byteorder=sys.byteorder))
 
+        # Let cuDNN benchmark and pick the fastest convolution algorithms for each input
+        # shape, the batch widths are bounded by max_len
+        torch.backends.cudnn.benchmark = True
+
         preprocessed_data = self.load_preprocessed_data()
-        self.fields, self.vocab = self.build_fields_and_vocab(preprocessed_data)
+        self.text_field, self.vocab = self.build_text_field_and_vocab(preprocessed_data)
+        self.text = self.numericalize(preprocessed_data)
+
+        # Build the model once, its parameters are initialized again at the start of each fold
+        self.model = self.build_model()
+        if self.use_cuda:
+            self.model.cuda()
 
         train_df = common.load_data('train')
-        train_df['comment_text'] = train_df['id'].map(preprocessed_data)
         test_df = common.load_data('test')
-        test_df['comment_text'] = test_df['id'].map(preprocessed_data)
+
+        # Keep the predictions in memory instead of reading back the CSV files
+        val_preds = []
+        test_id, test_iter = self.build_prediction_iterator(test_df)
+        test_pred_sum = np.zeros((test_df.shape[0], len(common.LABELS)), dtype=np.float32)
 
         folds = common.stratified_kfold(train_df, random_seed=self.random_seed)
         for fold_num, train_ids, val_ids in folds:
@@ -82,33 +220,29 @@ class BaseModel(object):
 
             fold_train_df = train_df[train_df['id'].isin(train_ids)]
             fold_val_df = train_df[train_df['id'].isin(val_ids)]
-            model = self.train(fold_num, fold_train_df, fold_val_df)
+            train_iter = self.build_train_iterator(fold_train_df)
+            val_id, val_iter = self.build_prediction_iterator(fold_val_df)
+            model = self.train(fold_num, train_iter, val_iter)
 
             logger.info('Generating the out-of-fold predictions')
             path = os.path.join(self.output_dir, f'fold{fold_num}_validation.csv')
-            self.predict(model, fold_val_df, path)
+            val_preds.append(self.predict(model, val_id, val_iter, path))
 
             logger.info('Generating the test predictions')
             path = os.path.join(self.output_dir, f'fold{fold_num}_test.csv')
-            self.predict(model, test_df, path)
+            test_pred = self.predict(model, test_id, test_iter, path)
+            # Some models predict in a different order than the input
+            test_pred = test_pred.set_index('id').loc[test_df['id'], common.LABELS]
+            test_pred_sum += test_pred.values
 
         logger.info('Combining the out-of-fold predictions')
-        df_parts = []
-        for fold_num in range(1, 11):
-            path = os.path.join(self.output_dir, f'fold{fold_num}_validation.csv')
-            df_part = pd.read_csv(path, usecols=['id'] + common.LABELS)
-            df_parts.append(df_part)
-        train_pred = pd.concat(df_parts)
+        train_pred = pd.concat(val_preds)
         path = os.path.join(self.output_dir, 'train.csv')
         train_pred.to_csv(path, index=False)
 
         logger.info('Averaging the test predictions')
-        df_parts = []
-        for fold_num in range(1, 11):
-            path = os.path.join(self.output_dir, f'fold{fold_num}_test.csv')
-            df_part = pd.read_csv(path, usecols=['id'] + common.LABELS)
-            df_parts.append(df_part)
-        test_pred = pd.concat(df_parts).groupby('id', as_index=False).mean()
+        test_pred = pd.DataFrame(test_pred_sum / len(val_preds), columns=common.LABELS)
+        test_pred.insert(0, 'id', test_df['id'].values)
         path = os.path.join(self.output_dir, 'test.csv')
         test_pred.to_csv(path, index=False)
 
@@ -118,52 +252,67 @@ class BaseModel(object):
         preprocessed_data = preprocessing.load(self.params)
         return preprocessed_data
 
-    def build_fields_and_vocab(self, preprocessed_data):
-        text_field = Field(pad_token='<PAD>', unk_token=None, batch_first=True, include_lengths=True)
-        labels_field = Field(sequential=False, use_vocab=False, tensor_type=torch.FloatTensor)
-        fields = [('text', text_field), ('labels', labels_field)]
-
-        # Build the vocabulary
-        datasets = []
-        for dataset in ['train', 'test']:
-            df = common.load_data(dataset)
-            df['comment_text'] = df['id'].map(preprocessed_data)
-            datasets.append(CommentsDataset(df, fields))
-        text_field.build_vocab(*datasets)
+    def build_text_field_and_vocab(self, preprocessed_data):
+        # The field only tokenizes the comments and builds the vocabulary, the batches
+        # are numericalized and padded by CommentsDataset and collate_comments
+        text_field = Field(pad_token='<PAD>', unk_token=None)
+
+        # The vocabulary only depends on the preprocessed data and the word vectors. Hash the
+        # ids and delimiters too, so that the comment boundaries are part of the key
+        data_hash = hashlib.md5(f'{VOCAB_VERSION}\t{self.params["vectors"]}\n'.encode())
+        for id_ in sorted(preprocessed_data):
+            data_hash.update(f'{id_}\t{preprocessed_data[id_]}\n'.encode())
+        vocab_file = os.path.join(VOCAB_DIR, data_hash.hexdigest())
+
+        if os.path.isfile(vocab_file):
+            logger.info(f'Loading {vocab_file[len(common.OUTPUT_DIR) + 1:]}')
+            text_field.vocab = torch.load(vocab_file)
+        else:
+            logger.info(f'Generating {vocab_file[len(common.OUTPUT_DIR) + 1:]}')
+            text_field.vocab = self.build_vocab(text_field, preprocessed_data)
+            torch.save(text_field.vocab, vocab_file)
+
+        return text_field, text_field.vocab
+
+    def numericalize(self, preprocessed_data):
+        # Convert the tokens to indices once, instead of for every fold
+        text_field = self.text_field
+        stoi = self.vocab.stoi
+        text = {}
+        for id_, comment in preprocessed_data.items():
+            tokens = text_field.preprocess(comment)
+            text[id_] = np.fromiter((stoi[t] for t in tokens), dtype=np.int32, count=len(tokens))
+        return text
+
+    def build_vocab(self, text_field, preprocessed_data):
+        # The preprocessed data already contains the comments of both datasets
+        text_field.build_vocab(text_field.preprocess(text) for text in preprocessed_data.values())
         vocab = text_field.vocab
         assert vocab.stoi['<PAD>'] == 0
 
         # Fill in missing words with the mean of the existing vectors
         vectors = pretrained_aliases[self.params['vectors']]()
-        vectors_sum = np.zeros((vectors.dim, ))
-        vectors_count = 0
-        for token in vocab.itos:
-            if token in vectors.stoi:
-                vectors_sum += vectors[token].numpy()
-                vectors_count += 1
-        mean_vector = torch.FloatTensor(vectors_sum / vectors_count).unsqueeze(0)
-
-        def getitem(self, token):
-            return self.vectors[self.stoi[token]] if token in self.stoi else mean_vector
-        Vectors.__getitem__ = getitem
+        known = [(i, vectors.stoi[token]) for i, token in enumerate(vocab.itos) if token in vectors.stoi]
+        vocab_indices, vectors_indices = map(torch.LongTensor, zip(*known))
+        known_vectors = vectors.vectors.index_select(0, vectors_indices)
+        vocab.vectors = known_vectors.mean(0, keepdim=True).repeat(len(vocab), 1)
+        vocab.vectors.index_copy_(0, vocab_indices, known_vectors)
 
-        vocab.load_vectors(vectors)
+        return vocab
 
-        return fields, vocab
-
-    def train(self, fold_num, train_df, val_df):
-        train_iter = self.build_train_iterator(train_df)
-        _, val_iter = self.build_prediction_iterator(val_df)
+    def train(self, fold_num, train_iter, val_iter):
         logger.info('Training on {:,} examples, validating on {:,} examples'
                     .format(len(train_iter.dataset), len(val_iter.dataset)))
 
         # Train the model keeping the word embeddings frozen until the validation AUC
         # stops improving, then unfreeze the embeddings and fine-tune the entire
         # model with a lower learning rate. Use SGD with warm restarts.
-        model = self.build_model()
+        # Each fold starts from its own random initialization of the same instance
+        model = self.model
+        model.reset_parameters()
         model.embedding.weight.requires_grad = False
         parameters = list(filter(lambda p: p.requires_grad, model.parameters()))
-        model_size = sum([np.prod(p.size()) for p in parameters])
+        model_size = sum(p.data.numel() for p in parameters)
         logger.info('Optimizing {:,} parameters:\n{}'.format(model_size, model))
         run = epoch = 0
         lr_max = self.params['lr_high']
@@ -174,9 +323,8 @@ class BaseModel(object):
         while True:
             run += 1
             # grad_norms = []
-            t_cur, lr = 0, lr_max
-            for param_group in optimizer.param_groups:
-                param_group['lr'] = lr
+            # Anneal the learning rate from lr_max to zero over the run, one step per batch
+            scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, t_max * len(train_iter))
 
             logger.info('Starting run {} - t_max {}'.format(run, t_max))
             for t_index in range(t_max):
@@ -185,12 +333,12 @@ class BaseModel(object):
                 model.train()
                 t = tqdm(train_iter, ncols=79)
                 for batch_index, batch in enumerate(t):
-                    # Update the learning rate
+                    # Step before the batch: in PyTorch 0.3 the scheduler starts at last_epoch -1,
+                    # so the first step sets the learning rate of batch 0
+                    scheduler.step()
                     t_cur = t_index + batch_index / len(train_iter)
-                    lr = lr_max * (1 + math.cos(math.pi * t_cur / t_max)) / 2
+                    lr = optimizer.param_groups[0]['lr']
                     t.set_postfix(t_cur='{:.4f}'.format(t_cur), lr='{:.6f}'.format(lr))
-                    for param_group in optimizer.param_groups:
-                        param_group['lr'] = lr
                     # Forward and backward pass
                     optimizer.zero_grad()
                     loss = self.calculate_loss(model, batch)
@@ -198,8 +346,9 @@ class BaseModel(object):
                     # grad_vector = [p.grad.data.view(-1) for p in parameters]
                     # grad_norms.append(torch.cat(grad_vector).norm())
                     self.update_parameters(model, optimizer, loss)
-                    loss_sum += loss.data[0]
-                loss = loss_sum / len(train_iter)
+                    # Accumulate on the GPU, reading back loss.data[0] would synchronize
+                    loss_sum += loss.data
+                loss = loss_sum[0] / len(train_iter)
                 logger.info('Epoch {} - run {} - t_cur {}/{} - lr {:.6f} - loss {:.6f}'
                             .format(epoch, run, int(math.ceil(t_cur)), t_max, lr, loss))
 
@@ -221,7 +370,7 @@ class BaseModel(object):
                     model = self.load_model(fold_num)
                     model.embedding.weight.requires_grad = True
                     parameters = list(filter(lambda p: p.requires_grad, model.parameters()))
-                    model_size = sum([np.prod(p.size()) for p in parameters])
+                    model_size = sum(p.data.numel() for p in parameters)
                     logger.info('Fine-tuning {:,} parameters - best_val_auc {:.6f}'
                                 .format(model_size, best_val_auc))
                     run = 0
@@ -233,19 +382,19 @@ class BaseModel(object):
         model = self.load_model(fold_num)
         return model
 
-    def predict(self, model, df, output_path):
+    def predict(self, model, pred_id, pred_iter, output_path):
         model.eval()
         predictions = []
-        pred_id, pred_iter = self.build_prediction_iterator(df)
         for batch in pred_iter:
             (text, text_lengths), _ = batch.text, batch.labels
             output = model(text, text_lengths)
-            predictions.append(output.data.cpu())
-        predictions = torch.cat(predictions).numpy()
+            predictions.append(output.data)
+        predictions = torch.cat(predictions).cpu().numpy()
 
         predictions = pd.DataFrame(predictions, columns=common.LABELS)
         predictions.insert(0, 'id', pred_id)
         predictions.to_csv(output_path, index=False)
+        return predictions
 
     def build_train_iterator(self, df):
         raise NotImplementedError
@@ -270,11 +419,12 @@ class BaseModel(object):
         labels, predictions = [], []
         for batch in batch_iter:
             text, text_lengths = batch.text
-            labels.append(batch.labels.data.cpu())
+            labels.append(batch.labels.data)
             output = model(text, text_lengths)
-            predictions.append(output.data.cpu())
-        labels = torch.cat(labels).numpy()
-        predictions = torch.cat(predictions).numpy()
+            predictions.append(output.data)
+        # Copy the results to the host once, instead of synchronizing on every batch
+        labels = torch.cat(labels).cpu().numpy()
+        predictions = torch.cat(predictions).cpu().numpy()
         auc = roc_auc_score(labels, predictions, average='macro')
         return auc
 
@@ -283,10 +433,9 @@ class BaseModel(object):
         torch.save(model.state_dict(), path)
 
     def load_model(self, fold_num):
-        model = self.build_model()
         path = os.path.join(self.output_dir, f'fold{fold_num}.pickle')
-        model.load_state_dict(torch.load(path))
-        return model
+        self.model.load_state_dict(torch.load(path))
+        return self.model
 
 
 class BaseModule(nn.Module):
@@ -294,9 +443,15 @@ class BaseModule(nn.Module):
     def __init__(self, vocab):
         super().__init__()
         vocab_size, embed_size = vocab.vectors.shape
+        self.pad_index = vocab.stoi['<PAD>']
+        # Keep the pretrained vectors, the embeddings are fine-tuned and restored for each fold
+        self.vectors = vocab.vectors
         self.embedding = nn.Embedding(vocab_size, embed_size, padding_idx=0)
-        self.embedding.weight.data.copy_(vocab.vectors)
-        self.embedding.weight.data[vocab.stoi['<PAD>'], :] = 0
+
+    def reset_parameters(self):
+        # The subclasses call this at the end of their constructor
+        self.embedding.weight.data.copy_(self.vectors)
+        self.embedding.weight.data[self.pad_index, :] = 0
 
 
 class Dense(nn.Module):
@@ -345,8 +500,14 @@ class Dense(nn.Module):
             layers.append(self.nonlinearities[output_nonlinearity])
 
         self.dense = nn.Sequential(*layers)
-
-        # Weight initialization
+        self.hidden_nonlinearity = hidden_nonlinearity
+        self.output_nonlinearity = output_nonlinearity
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        hidden_nonlinearity = self.hidden_nonlinearity
+        output_nonlinearity = self.output_nonlinearity
+        layers = list(self.dense)
         for layer in layers:
             if isinstance(layer, nn.Linear):
                 gain = nn.init.calculate_gain(hidden_nonlinearity) if hidden_nonlinearity else 1.0
@@ -368,6 +529,7 @@ class WeightDrop(torch.nn.Module):
         self.module = module
         self.weights = weights
         self.dropout = dropout
+        self.masks = {}
         self._setup()
 
     def no_op(*args, **kwargs):
@@ -386,7 +548,16 @@ class WeightDrop(torch.nn.Module):
     def _setweights(self):
         for w_name in self.weights:
             raw_w = getattr(self.module, w_name + '_raw')
-            w = F.dropout(raw_w, p=self.dropout, training=self.training)
+            if self.training and self.dropout:
+                # Sample the dropout mask into a buffer that is reused on every forward pass
+                mask = self.masks.get(w_name)
+                if mask is None or mask.type() != raw_w.data.type():
+                    mask = self.masks[w_name] = raw_w.data.new(raw_w.size())
+                mask.bernoulli_(1 - self.dropout).div_(1 - self.dropout)
+                w = raw_w * Variable(mask)
+            else:
+                # Assigning the parameter itself would register it under the plain name
+                w = raw_w * 1
             setattr(self.module, w_name, w)
 
     def forward(self, *args):
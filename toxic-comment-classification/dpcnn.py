@@ -2,7 +2,6 @@
 
 from torch import nn
 import torch.nn.functional as F
-from torchtext.data import Iterator
 
 import common
 import base
@@ -15,21 +14,27 @@ class ConvBlock(nn.Module):
 
         self.relu1 = nn.ReLU()
         self.batchnorm1 = nn.BatchNorm1d(channels)
-        self._init_batchnorm(self.batchnorm1)
         if dropout:
             self.dropout1 = nn.Dropout(dropout)
         self.conv1 = nn.Conv1d(channels, channels, kernel_size=3, padding=1)
-        self._init_conv(self.conv1)
 
         self.relu2 = nn.ReLU()
         self.batchnorm2 = nn.BatchNorm1d(channels)
-        self._init_batchnorm(self.batchnorm2)
         if dropout:
             self.dropout2 = nn.Dropout(dropout)
         self.conv2 = nn.Conv1d(channels, channels, kernel_size=3, padding=1)
+
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        self._init_batchnorm(self.batchnorm1)
+        self._init_conv(self.conv1)
+        self._init_batchnorm(self.batchnorm2)
         self._init_conv(self.conv2)
 
     def _init_batchnorm(self, module):
+        # Also resets the running statistics
+        module.reset_parameters()
         nn.init.constant(module.weight, 1.0)
         nn.init.constant(module.bias, 0.0)
 
@@ -69,6 +74,14 @@ class DPCNNModule(base.BaseModule):
             input_dropout=dense_dropout,
             hidden_dropout=dense_dropout)
 
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        super().reset_parameters()
+        for k in range(1, self.conv_blocks + 1):
+            getattr(self, f'conv_block{k}').reset_parameters()
+        self.dense.reset_parameters()
+
     def forward(self, text, text_lengths):
         vectors = self.embedding(text)
         vectors = vectors.permute(0, 2, 1).contiguous()
@@ -79,8 +92,9 @@ class DPCNNModule(base.BaseModule):
             block = getattr(self, f'conv_block{k}')
             conv_output = conv_output + block(conv_output)
 
-        pooling_output = F.max_pool1d(conv_output, conv_output.shape[-1])
-        output = self.dense(pooling_output.squeeze(-1))
+        # Maximum over the whole sequence, a plain reduction instead of a pooling window
+        pooling_output, _ = conv_output.max(-1)
+        output = self.dense(pooling_output)
 
         return output
 
@@ -88,18 +102,18 @@ class DPCNNModule(base.BaseModule):
 class DPCNN(base.BaseModel):
 
     def build_train_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
-        train_iter = Iterator(
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
+        train_iter = base.CommentsLoader(
             dataset, batch_size=self.params['batch_size'],
-            repeat=False, shuffle=True)
+            shuffle=True, use_cuda=self.use_cuda)
         return train_iter
 
     def build_prediction_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
         pred_id = list(df['id'].values)
-        pred_iter = Iterator(
+        pred_iter = base.CommentsLoader(
             dataset, batch_size=self.params['batch_size'],
-            repeat=False, shuffle=False, sort=False)
+            use_cuda=self.use_cuda, volatile=True)
         return pred_id, pred_iter
 
     def build_model(self):
@@ -110,7 +124,7 @@ class DPCNN(base.BaseModel):
             dense_layers=self.params['dense_layers'],
             dense_nonlinearily='relu',
             dense_dropout=self.params['dense_dropout'])
-        return model.cuda()
+        return model
 
 
 if __name__ == '__main__':
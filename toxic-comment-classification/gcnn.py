@@ -5,7 +5,6 @@ from torch import nn, autograd
 from torch.nn.utils.clip_grad import clip_grad_norm
 from torch.nn.utils import weight_norm
 import torch.nn.functional as F
-from torchtext.data import Iterator
 
 import common
 import base
@@ -19,25 +18,29 @@ class GLU(nn.Module):
         self.in_channels = in_channels
         self.kernel_size = kernel_size
 
-        self.conv_linear = nn.Conv1d(in_channels, out_channels, kernel_size)
-        self._init_conv(self.conv_linear)
-        self.conv_linear = weight_norm(self.conv_linear)
+        self.conv_linear = weight_norm(nn.Conv1d(in_channels, out_channels, kernel_size))
+        self.conv_gate = weight_norm(nn.Conv1d(in_channels, out_channels, kernel_size))
+
+        self.reset_parameters()
 
-        self.conv_gate = nn.Conv1d(in_channels, out_channels, kernel_size)
+    def reset_parameters(self):
+        self._init_conv(self.conv_linear)
         self._init_conv(self.conv_gate)
-        self.conv_gate = weight_norm(self.conv_gate)
 
     def _init_conv(self, module):
-        nn.init.normal(module.weight, mean=0, std=0.01)
+        # Initialize the direction like the weight itself, and its norm so that
+        # the initial weight is unchanged by the normalization
+        nn.init.normal(module.weight_v, mean=0, std=0.01)
+        weight_v = module.weight_v.data
+        norm = weight_v.view(weight_v.shape[0], -1).norm(2, 1)
+        module.weight_g.data.copy_(norm.view_as(module.weight_g.data))
         nn.init.constant(module.bias, 0.0)
 
     def forward(self, x):
         # Zero-pad the beginning of the sequence with kernel_size - 1 elements
         batch_size = x.shape[0]
-        padding = torch.zeros(batch_size, self.in_channels, self.kernel_size - 1)
+        padding = x.data.new(batch_size, self.in_channels, self.kernel_size - 1).zero_()
         padding = autograd.Variable(padding, requires_grad=False)
-        if torch.cuda.is_available():
-            padding = padding.cuda()
         x_padded = torch.cat([padding, x], dim=-1)
 
         a = self.conv_linear(x_padded)
@@ -56,6 +59,10 @@ class ResidualBlock(nn.Module):
             layer = GLU(in_channels, out_channels, kernel_size)
             setattr(self, f'layer{i}', layer)
 
+    def reset_parameters(self):
+        for i in range(1, self.num_layers + 1):
+            getattr(self, f'layer{i}').reset_parameters()
+
     def forward(self, x):
         h = x
         for i in range(1, self.num_layers + 1):
@@ -87,6 +94,15 @@ class GCNNModule(base.BaseModule):
             input_dropout=dense_dropout,
             hidden_dropout=dense_dropout)
 
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        super().reset_parameters()
+        self.glu0.reset_parameters()
+        for i in range(1, self.num_blocks + 1):
+            getattr(self, f'block{i}').reset_parameters()
+        self.dense.reset_parameters()
+
     def forward(self, text, text_lengths):
         vectors = self.embedding(text)
         vectors = vectors.permute(0, 2, 1).contiguous()
@@ -96,8 +112,9 @@ class GCNNModule(base.BaseModule):
             block = getattr(self, f'block{i}')
             conv_output = block(conv_output)
 
-        pooling_output = F.max_pool1d(conv_output, conv_output.shape[-1])
-        output = self.dense(pooling_output.squeeze(-1))
+        # Maximum over the whole sequence, a plain reduction instead of a pooling window
+        pooling_output, _ = conv_output.max(-1)
+        output = self.dense(pooling_output)
 
         return output
 
@@ -105,18 +122,18 @@ class GCNNModule(base.BaseModule):
 class GCNN(base.BaseModel):
 
     def build_train_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
-        train_iter = Iterator(
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
+        train_iter = base.CommentsLoader(
             dataset, batch_size=self.params['batch_size'],
-            repeat=False, shuffle=True)
+            shuffle=True, use_cuda=self.use_cuda)
         return train_iter
 
     def build_prediction_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
         pred_id = list(df['id'].values)
-        pred_iter = Iterator(
+        pred_iter = base.CommentsLoader(
             dataset, batch_size=self.params['batch_size'],
-            repeat=False, shuffle=False, sort=False)
+            use_cuda=self.use_cuda, volatile=True)
         return pred_id, pred_iter
 
     def build_model(self):
@@ -128,7 +145,7 @@ class GCNN(base.BaseModel):
             kernel_size=self.params['kernel_size'],
             dense_layers=self.params['dense_layers'],
             dense_dropout=self.params['dense_dropout'])
-        return model.cuda()
+        return model
 
     def update_parameters(self, model, optimizer, loss):
         parameters = filter(lambda p: p.requires_grad, model.parameters())
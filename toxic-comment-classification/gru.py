@@ -9,7 +9,6 @@ from torch import nn
 import torch.nn.functional as F
 from torch.nn.utils.clip_grad import clip_grad_norm
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-from torchtext.data import Iterator
 from unidecode import unidecode
 
 import spacy
@@ -58,14 +57,6 @@ class GRUModule(base.BaseModule):
             bidirectional=True,
             batch_first=True)
 
-        for name, param in self.rnn.named_parameters():
-            if name.startswith('weight_ih_'):
-                nn.init.xavier_uniform(param)
-            elif name.startswith('weight_hh_'):
-                nn.init.orthogonal(param)
-            elif name.startswith('bias_'):
-                nn.init.constant(param, 0.0)
-
         self.annotation = base.Dense(
             3 * embedding_size, embedding_size,
             hidden_layers=1,
@@ -74,13 +65,27 @@ class GRUModule(base.BaseModule):
             dropout=annotation_dropout)
 
         self.label_vectors = nn.Parameter(torch.zeros(len(common.LABELS), embedding_size))
-        nn.init.uniform(self.label_vectors, -1, 1)
 
         self.prediction = base.Dense(
             embedding_size, 1,
             output_nonlinearity='sigmoid',
             dropout=prediction_dropout)
 
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        super().reset_parameters()
+        for name, param in self.rnn.named_parameters():
+            if name.startswith('weight_ih_'):
+                nn.init.xavier_uniform(param)
+            elif name.startswith('weight_hh_'):
+                nn.init.orthogonal(param)
+            elif name.startswith('bias_'):
+                nn.init.constant(param, 0.0)
+        self.annotation.reset_parameters()
+        nn.init.uniform(self.label_vectors, -1, 1)
+        self.prediction.reset_parameters()
+
     def forward(self, text, text_lengths):
         vectors = self.embedding(text)
 
@@ -140,24 +145,21 @@ class GRU(base.BaseModel):
         return preprocessed_data
 
     def build_train_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
-        train_iter = Iterator(
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
+        train_iter = base.CommentsLoader(
             dataset, batch_size=self.params['batch_size'],
-            repeat=False, sort_within_batch=True, shuffle=True,
-            sort_key=lambda x: len(x.text),
-            device=None if torch.cuda.is_available() else -1)
+            shuffle=True, sort_within_batch=True,
+            use_cuda=self.use_cuda)
         return train_iter
 
     def build_prediction_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
-        # Reorder the examples (required by pack_padded_sequence)
-        sort_indices = sorted(range(len(dataset)), key=lambda i: -len(dataset[i].text))
-        pred_id = [df['id'].iloc[i] for i in sort_indices]
-        dataset.examples = [dataset.examples[i] for i in sort_indices]
-        pred_iter = Iterator(
-            dataset, batch_size=self.params['batch_size'],
-            repeat=False, shuffle=False, sort=False,
-            device=None if torch.cuda.is_available() else -1)
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
+        # Iterate over the examples by decreasing length (required by pack_padded_sequence)
+        sort_indices = np.argsort(-dataset.lengths, kind='mergesort')
+        pred_id = df['id'].values[sort_indices]
+        pred_iter = base.CommentsLoader(
+            dataset, batch_size=self.params['batch_size'], sampler=sort_indices,
+            use_cuda=self.use_cuda, volatile=True)
         return pred_id, pred_iter
 
     def build_model(self):
@@ -165,8 +167,6 @@ class GRU(base.BaseModel):
             vocab=self.vocab,
             annotation_dropout=self.params['annotation_dropout'],
             prediction_dropout=self.params['prediction_dropout'])
-        if torch.cuda.is_available():
-            model = model.cuda()
         return model
 
     def update_parameters(self, model, optimizer, loss):
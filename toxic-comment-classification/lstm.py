@@ -1,10 +1,9 @@
+import numpy as np
 import torch
 from torch import nn
-import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.nn.utils.clip_grad import clip_grad_norm
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-from torchtext.data import Iterator
 
 import common
 import base
@@ -15,51 +14,67 @@ class LSTMModule(base.BaseModule):
     def __init__(self, vocab, rnn_size, rnn_layers, rnn_dropout,
                  dense_layers, dense_nonlinearily, dense_dropout):
         super().__init__(vocab)
+        self.embed_dim = int(vocab.vectors.shape[1])
+        self.num_labels = len(common.LABELS)
 
         h0 = torch.zeros(2 * rnn_layers, 1, rnn_size)
         self.rnn_h0 = nn.Parameter(h0, requires_grad=True)
 
         self.rnn = nn.LSTM(
-            input_size=vocab.vectors.shape[1],
+            input_size=self.embed_dim,
             hidden_size=rnn_size,
             num_layers=rnn_layers,
-            bidirectional=True,
-            batch_first=True)
-
-        for name, param in self.rnn.named_parameters():
-            if name.startswith('weight_ih_'):
-                nn.init.xavier_uniform(param)
-            elif name.startswith('weight_hh_'):
-                nn.init.orthogonal(param)
-            elif name.startswith('bias_'):
-                nn.init.constant(param, 0.0)
+            bidirectional=True)
 
         if rnn_dropout:
             weights = ['weight_hh_l{}'.format(k) for k in range(rnn_layers)]
             self.rnn = base.WeightDrop(self.rnn, weights, dropout=rnn_dropout)
 
         self.dense = base.Dense(
-            2 * rnn_size, len(common.LABELS),
+            2 * rnn_size, self.num_labels,
             output_nonlinearity='sigmoid',
             hidden_layers=dense_layers,
             hidden_nonlinearity=dense_nonlinearily,
             dropout=dense_dropout)
 
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        super().reset_parameters()
+        self.rnn_h0.data.zero_()
+        # WeightDrop prefixes the names with module. and suffixes the dropped weights with _raw
+        params = [(name.split('.')[-1], param) for name, param in self.rnn.named_parameters()]
+        ih_weights = [p for n, p in params if n.startswith('weight_ih_')]
+        hh_weights = [p for n, p in params if n.startswith('weight_hh_')]
+        biases = [p for n, p in params if n.startswith('bias_')]
+        for weight in ih_weights:
+            nn.init.xavier_uniform(weight)
+        for weight in hh_weights:
+            nn.init.orthogonal(weight)
+        for bias in biases:
+            bias.data.zero_()
+        self.dense.reset_parameters()
+
     def forward(self, text, text_lengths):
-        vectors = self.embedding(text)
+        # Work in the (seq_len, batch, features) layout of cuDNN, transposing the token
+        # indices instead of the embedded vectors
+        vectors = self.embedding(text.t().contiguous())
 
-        packed_vectors = pack_padded_sequence(vectors, text_lengths.tolist(), batch_first=True)
+        packed_vectors = pack_padded_sequence(vectors, text_lengths.tolist())
         h0 = self.rnn_h0.expand(-1, text.shape[0], -1).contiguous()
         c0 = Variable(h0.data.new(h0.size()).zero_().contiguous())
         packed_rnn_output, _ = self.rnn(packed_vectors, (h0, c0))
 
-        rnn_output, _ = pad_packed_sequence(packed_rnn_output, batch_first=True)
-        # Permute to (batch, hidden_size * num_directions, seq_len)
-        rnn_output = rnn_output.permute(0, 2, 1)
+        rnn_output, _ = pad_packed_sequence(packed_rnn_output)
 
-        # Make sure that the zero padding doesn't interfere with the maximum
-        zeros_as_min = rnn_output + rnn_output.min() * (rnn_output == 0).float()
-        rnn_output_max = F.max_pool1d(zeros_as_min, rnn_output.shape[-1]).squeeze(-1)
+        # Make sure that the zero padding doesn't interfere with the maximum. The mask is
+        # built from the tokens, which are already on the device, unlike the lengths
+        padding_mask = text.data.t()[:rnn_output.shape[0]] == self.pad_index
+        padding_mask = padding_mask.unsqueeze(-1).expand_as(rnn_output.data)
+        rnn_output = rnn_output.masked_fill(Variable(padding_mask), -float('inf'))
+
+        # Maximum over the time dimension, without permuting to (batch, features, seq_len)
+        rnn_output_max, _ = rnn_output.max(0)
 
         output = self.dense(rnn_output_max)
         return output
@@ -68,22 +83,21 @@ class LSTMModule(base.BaseModule):
 class LSTM(base.BaseModel):
 
     def build_train_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
-        train_iter = Iterator(
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
+        train_iter = base.CommentsLoader(
             dataset, batch_size=self.params['batch_size'],
-            repeat=False, sort_within_batch=True, shuffle=True,
-            sort_key=lambda x: len(x.text))
+            bucket=True, sort_within_batch=True,
+            use_cuda=self.use_cuda)
         return train_iter
 
     def build_prediction_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
-        # Reorder the examples (required by pack_padded_sequence)
-        sort_indices = sorted(range(len(dataset)), key=lambda i: -len(dataset[i].text))
-        pred_id = [df['id'].iloc[i] for i in sort_indices]
-        dataset.examples = [dataset.examples[i] for i in sort_indices]
-        pred_iter = Iterator(
-            dataset, batch_size=self.params['batch_size'],
-            repeat=False, shuffle=False, sort=False)
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
+        # Iterate over the examples by decreasing length (required by pack_padded_sequence)
+        sort_indices = np.argsort(-dataset.lengths, kind='mergesort')
+        pred_id = df['id'].values[sort_indices]
+        pred_iter = base.CommentsLoader(
+            dataset, batch_size=self.params['batch_size'], sampler=sort_indices,
+            use_cuda=self.use_cuda, volatile=True)
         return pred_id, pred_iter
 
     def build_model(self):
@@ -95,7 +109,7 @@ class LSTM(base.BaseModel):
             dense_layers=self.params['dense_layers'],
             dense_nonlinearily='relu',
             dense_dropout=self.params['dense_dropout'])
-        return model.cuda()
+        return model
 
     def update_parameters(self, model, optimizer, loss):
         parameters = filter(lambda p: p.requires_grad, model.parameters())
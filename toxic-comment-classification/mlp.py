@@ -1,6 +1,5 @@
 import torch
 from torch.autograd import Variable
-from torchtext.data import Iterator
 
 import common
 import base
@@ -20,10 +19,18 @@ class MLPModule(base.BaseModule):
             input_dropout=input_dropout,
             hidden_dropout=hidden_dropout)
 
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        super().reset_parameters()
+        self.dense.reset_parameters()
+
     def forward(self, text, text_lengths):
         vectors = self.embedding(text)
         vectors = vectors.permute(0, 2, 1)
-        mean_vectors = torch.sum(vectors, -1) / Variable(text_lengths.unsqueeze(-1)).float()
+        # Count the tokens on the device, the lengths are on the CPU
+        counts = text.data.ne(self.pad_index).type_as(vectors.data).sum(1, keepdim=True)
+        mean_vectors = torch.sum(vectors, -1) / Variable(counts)
         output = self.dense(mean_vectors)
         return output
 
@@ -31,18 +38,18 @@ class MLPModule(base.BaseModule):
 class MLP(base.BaseModel):
 
     def build_train_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
-        train_iter = Iterator(
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
+        train_iter = base.CommentsLoader(
             dataset, batch_size=self.params['batch_size'],
-            repeat=False, shuffle=True)
+            shuffle=True, use_cuda=self.use_cuda)
         return train_iter
 
     def build_prediction_iterator(self, df):
-        dataset = base.CommentsDataset(df, self.fields)
+        dataset = base.CommentsDataset(df, self.text, self.vocab)
         pred_id = list(df['id'].values)
-        pred_iter = Iterator(
+        pred_iter = base.CommentsLoader(
             dataset, batch_size=self.params['batch_size'],
-            repeat=False, shuffle=False, sort=False)
+            use_cuda=self.use_cuda, volatile=True)
         return pred_id, pred_iter
 
     def build_model(self):
@@ -53,8 +60,6 @@ class MLP(base.BaseModel):
             hidden_nonlinearity='relu',
             input_dropout=self.params['input_dropout'],
             hidden_dropout=self.params['hidden_dropout'])
-        if torch.cuda.is_available():
-            model = model.cuda()
         return model
 
 